@@ -8,22 +8,37 @@
 from __future__ import print_function
 
 import argparse
+import functools
 import io
 import json
+import mmap
 import os
 import re
+import struct
 import sys
 
 
 try:
-    from urllib import unquote_plus  # Python 2
+    from urllib import unquote as unquote_to_bytes  # Python 2
 except ImportError:
-    from urllib.parse import unquote_plus  # Python 3
+    from urllib.parse import unquote_to_bytes  # Python 3
+
+snappy_uncompress = None  # imported by `decompress` on first use
 
 
 LEVELDB_ROOTLIST_KEY = b"!pl#slc#{}#"
 ROOTLIST_ID = b"spotify:user:{}:rootlist"
 
+# A row runs from "spotify:{playlist,start-group,end-group}:" up to the
+# next '\x12' or the next "spotify:" that starts another row. The index
+# of the group that matched tells which of the three kinds it is.
+ROOTLIST_ROW_REST = rb"((?:[^\x12s]+|s(?!potify:[pse]))*)"
+ROOTLIST_ROW_PATTERN = re.compile(
+    rb"spotify:(?:playlist:%b|start-group:%b|end-group:%b)"
+    % ((ROOTLIST_ROW_REST,) * 3)
+)
+PLAYLIST_ROW, START_GROUP_ROW, END_GROUP_ROW = 1, 2, 3
+
 if sys.platform == "darwin":
     # Mac
     PERSISTENT_CACHE_PATH = (
@@ -47,7 +62,7 @@ else:
     )
 
 
-def parse(data, user_id):
+def parse(data, user_id, target_folder_id=None):
     """
     Parse a Spotify PersistentStorage file with folder structure at start.
 
@@ -57,6 +72,11 @@ def parse(data, user_id):
         Specify a user id to use for folder URIs. Can also be a
         placeholder value like 'unknown'. (Background: this information
         doesn't seem to be provided in the source file.)
+    `target_folder_id`
+        Optionally, a folder id as accepted by `get_folder()`. Parsing
+        stops as soon as that folder is closed, and it is returned
+        instead of the entire hierarchy. Rows before that folder are
+        skipped without being decoded.
 
     FILE STRUCTURE
     --------------
@@ -80,46 +100,52 @@ def parse(data, user_id):
           (e.g. "spotify:end-group:8212237ac7347bfe")
       6. Other content we currently ignore.
     """
-    # spotify:playlist, spotify:start-group, spotify:end-group
-    rows = re.split(rb"spotify:(?=[pse])", data)
+    folder_uri_prefix = f"spotify:user:{user_id}:folder:"
     folder = {"type": "folder", "children": []}
     stack = []
-
-    for index, row in enumerate(rows):
-        # Note: '\x10' marks the end of the entire list. This might
-        # break in future versions of Spotify. Here are two alternative
-        # solutions one might consider then:
-        #   1. Read the length encoded as a varint before each string.
-        #   2. Read the number of repeats specified in the beginning of
-        #      the file.
-        chunks = row.split(b"\x12", 1)
-        row = chunks[0]
-        if row.startswith(b"playlist:"):
+    target = None
+
+    start = 0
+    if target_folder_id:
+        start = find_folder_start(data, folder_uri_prefix, target_folder_id)
+        if start is None:
+            return folder
+
+    for match in ROOTLIST_ROW_PATTERN.finditer(data, start):
+        # Note: a row ends at the next '\x12' (see ROOTLIST_ROW_PATTERN).
+        # This might break in future versions of Spotify. Once the new
+        # file structure is known, a sturdier alternative is to read the
+        # length encoded as a varint before each string (`decode_varint`).
+        kind = match.lastindex
+        if kind == PLAYLIST_ROW:
+            # the whole match is the URI, ready to decode
             folder["children"].append(
-                {"type": "playlist", "uri": "spotify:" + row.decode("utf-8")}
+                {"type": "playlist", "uri": match.group(0).decode("utf-8")}
             )
-        elif row.startswith(b"start-group:"):
+        elif kind == START_GROUP_ROW:
             stack.append(folder)
-            tags = row.split(b":")
-            folder = dict(
-                # Assuming folder names < 128 characters.
-                # Alternatively, do a protobuf varint parser to get length.
-                name=unquote_plus(tags[-1].decode("utf-8")),
-                type="folder",
-                uri=(
-                    "spotify:user:%s:folder:" % user_id
-                    + tags[-2].decode("utf-8").zfill(16)
-                ),
-                children=[],
-            )
-        elif row.startswith(b"end-group:"):
+            group_id, name = split_start_group(match.group(0))
+            if b"%" in name or b"+" in name:  # most names aren't escaped
+                name = unquote_to_bytes(name.replace(b"+", b" "))
+            folder = {
+                "name": name.decode("utf-8", "replace"),
+                "type": "folder",
+                "uri": folder_uri_prefix + group_id.decode("utf-8").zfill(16),
+                "children": [],
+            }
+            if (
+                target is None
+                and target_folder_id
+                and folder["uri"].endswith(target_folder_id)
+            ):
+                target = folder
+        elif kind == END_GROUP_ROW:
             parent = stack.pop()
             parent["children"].append(folder)
+            if folder is target:
+                return folder
             folder = parent
 
-        # if folder.get("children") and len(chunks) > 1:
-        #     break
-
     # close any remaining groups -- sometimes a file contains errors.
     while len(stack) > 0:
         parent = stack.pop()
@@ -129,16 +155,42 @@ def parse(data, user_id):
     return folder
 
 
+def split_start_group(row):
+    """Split "spotify:start-group:{group_id}:{name}" into id and name."""
+    # the last two ':'-separated fields, as `row.split(b":")[-2:]`
+    rest, _, name = row.rpartition(b":")
+    return rest.rpartition(b":")[2], name
+
+
+def find_folder_start(data, folder_uri_prefix, folder_id):
+    """Offset of the first start-group row with a URI ending in `folder_id`."""
+    # compare as bytes, so the rows that are skipped are never decoded
+    folder_uri_prefix = folder_uri_prefix.encode("utf-8")
+    folder_id = folder_id.encode("utf-8")
+    for match in ROOTLIST_ROW_PATTERN.finditer(data):
+        if match.lastindex != START_GROUP_ROW:
+            continue
+        group_id, _ = split_start_group(match.group(0))
+        if (folder_uri_prefix + group_id.zfill(16)).endswith(folder_id):
+            return match.start()
+
+
 def get_folder(folder_id, data):
     """Get a specific folder in data output by `parse()`."""
-    data_type = data.get("type")
-    if data_type == "folder":
-        if data.get("uri", "").endswith(folder_id):
-            return data
-        for child in data.get("children", []):
-            folder = get_folder(folder_id, child)
-            if folder:
-                return folder
+    if data.get("type") != "folder":
+        return None
+    # depth-first, in the same order as the hierarchy is written;
+    # only folders go on the stack, playlists are skipped right away.
+    stack = [data]
+    while stack:
+        folder = stack.pop()
+        if folder.get("uri", "").endswith(folder_id):
+            return folder
+        stack.extend(
+            child
+            for child in reversed(folder.get("children", []))
+            if child.get("type") == "folder"
+        )
 
 
 def get_leveldb_rootlist(user_id, cachedir):
@@ -148,16 +200,21 @@ def get_leveldb_rootlist(user_id, cachedir):
     else:
         dirpath = rootpath
 
-    # Two attempts
+    # Two attempts, over the same files
     key_template = LEVELDB_ROOTLIST_KEY
+    key = (
+        SpotifyLevelDB.make_key_from_user_id(key_template, user_id)
+        if user_id
+        else key_template
+    )
+    files_by_suffix = SpotifyLevelDB.list_files(dirpath)
     for slow_mode in (False, True):
-        key = (
-            SpotifyLevelDB.make_key_from_user_id(key_template, user_id)
-            if user_id
-            else key_template
-        )
         result = SpotifyLevelDB.get(
-            key, dirpath, key_is_template=not user_id, ignore_comparator=slow_mode
+            key,
+            dirpath,
+            key_is_template=not user_id,
+            ignore_comparator=slow_mode,
+            files_by_suffix=files_by_suffix,
         )
         if result[1]:
             return result
@@ -197,17 +254,21 @@ def print_info_text(user_ids):
     )
 
 
-def _process(raw_data, user_id="unknown", folder_id=None):
-    data = parse(raw_data, user_id=user_id)
+def _process(raw_data, user_id="unknown", folder_id=None, out=None):
+    data = parse(raw_data, user_id=user_id, target_folder_id=folder_id)
 
-    # postprocessing
+    # postprocessing: also covers a target folder that was never closed
     if folder_id:
         data = get_folder(folder_id, data)
         if not data:
             print("Folder not found :(")
             sys.exit(1)
 
-    return json.dumps(data)
+    # json.dumps, unlike json.dump, encodes with the C accelerator
+    if out is None:
+        out = sys.stdout
+    out.write(json.dumps(data, separators=(",", ":")))
+    out.write("\n")
 
 
 # ======================================================================
@@ -221,16 +282,21 @@ def _process(raw_data, user_id="unknown", folder_id=None):
 
 class SpotifyLevelDB:
     @staticmethod
-    def get(key, db_dirpath, key_is_template=False, ignore_comparator=False):
+    def get(
+        key,
+        db_dirpath,
+        key_is_template=False,
+        ignore_comparator=False,
+        files_by_suffix=None,
+    ):
         # passing a key with '{}' in it and `key_is_template=True` will
         # try to deduce a rootlist_id from the given files; the last
         # modified user is returned first. The rootlist_id is put at '{}'.
-        files_to_examine = get_files_in_dir_modified_last_first(db_dirpath)
+        if files_by_suffix is None:
+            files_by_suffix = SpotifyLevelDB.list_files(db_dirpath)
 
-        def seek(file_suffix, reader_cls, key):
+        def seek(files_to_examine, reader_cls, key):
             for filepath in files_to_examine:
-                if not filepath.endswith(file_suffix):
-                    continue
                 if key_is_template:
                     potential_key = SpotifyLevelDB.make_key_from_filepath(key, filepath)
                     if not potential_key:
@@ -245,19 +311,31 @@ class SpotifyLevelDB:
                     return user_id, value
 
         # Case 1: check log files (no external libraries needed)
-        result = seek(".log", LogReader, key)
+        result = seek(files_by_suffix[".log"], LogReader, key)
         if result:
             return result
 
         # Case 2: check ldb files (snappy may be needed)
-        result = seek(".ldb", TableReader, key)
+        result = seek(files_by_suffix[".ldb"], TableReader, key)
         if result:
             return result
 
         return None, None
 
     @staticmethod
+    def list_files(db_dirpath):
+        """Map ".log" and ".ldb" to their files, last modified first."""
+        files_by_suffix = {".log": [], ".ldb": []}
+        for filepath in get_files_in_dir_modified_last_first(db_dirpath):
+            suffix = os.path.splitext(filepath)[1]
+            if suffix in files_by_suffix:
+                files_by_suffix[suffix].append(filepath)
+        return files_by_suffix
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
     def extract_user_id_from_filepath(filepath):
+        # cached: called for every candidate file, and again on a match
         head = filepath
         last_head = ""
         while head != last_head:
@@ -290,6 +368,7 @@ class SpotifyLevelDB:
 # batch-fragments (last one can be smaller in size).
 # When these fragments are joined, they form a batch.
 
+ZERO_RECORD = 0  # preallocated space, never written
 FULL_RECORD = 1
 FIRST_RECORD = 2
 MIDDLE_RECORD = 3
@@ -301,18 +380,28 @@ class LogReader:
         self.reader = BytesReader(file, size)
 
     def __iter__(self):
-        batch_buffer = io.BytesIO()
+        for data in self.iter_batch_data():
+            yield Batch(data)
+
+    def __reversed__(self):
+        # Fragments only join up into batches when read front to back,
+        # so this collects the (undecoded) batches first.
+        for data in reversed(list(self.iter_batch_data())):
+            yield Batch(data)
+
+    def iter_batch_data(self):
+        fragments = []
         for block in LogBlockSequence(self.reader):
             for fragment in block:
-                batch_buffer.write(fragment.data)
+                fragments.append(fragment.data)
                 if fragment.type in (FULL_RECORD, LAST_RECORD):
-                    yield Batch(batch_buffer)
-                    clear(batch_buffer)
+                    yield b"".join(fragments)
+                    fragments.clear()
 
     @staticmethod
     def dump(filepath):
-        with open(filepath, "rb") as file:
-            for batch in LogReader(file, filesize(filepath)):
+        with open(filepath, "rb") as file, map_file(file) as data:
+            for batch in LogReader(data, filesize(filepath)):
                 print(f"--- batch {batch.sequence_number}")
                 for command, args in batch:
                     print(" ", command, " ".join(map(repr, args)))
@@ -320,16 +409,20 @@ class LogReader:
     @staticmethod
     def find(target_key, filepath):
         assert isinstance(target_key, bytes)
-        last_value = None
-        with open(filepath, "rb") as file:
-            for batch in LogReader(file, filesize(filepath)):
+        # return at the most recent batch with a match, since
+        # later batches overwrite earlier ones.
+        with open(filepath, "rb") as file, map_file(file) as data:
+            prefetch(file)
+            for batch in reversed(LogReader(data, filesize(filepath))):
+                last_value = None
                 for command, args in batch:
                     if command != "put":
                         continue
                     key, value = args
                     if key == target_key:
                         last_value = value
-        return last_value
+                if last_value is not None:
+                    return last_value
 
 
 class LogBlockSequence:
@@ -338,64 +431,70 @@ class LogBlockSequence:
 
     def __iter__(self):
         while True:
-            if not self.reader.bytes_left():
+            block = self.reader.n_bytes(LogBlock.MAX_BLOCK_SIZE)
+            if not block:
                 return
-            yield LogBlock(self.reader)
+            yield LogBlock(memoryview(block))
 
 
 class LogBlock:
     MAX_BLOCK_SIZE = 32 * 1024  # 32KB
 
-    def __init__(self, reader):
-        self.reader = reader.limit(LogBlock.MAX_BLOCK_SIZE)
+    def __init__(self, block):
+        self.block = block
 
     def __iter__(self):
-        while True:
-            if not self.reader.bytes_left():
+        block = self.block
+        offset = 0
+        # a tail too small for another header is just zero padding
+        last_offset = len(block) - Fragment.HEADER_SIZE
+        while offset <= last_offset:
+            fragment = Fragment(block, offset)
+            if fragment.type == ZERO_RECORD:
                 return
-            yield Fragment(self.reader)
+            yield fragment
+            offset += Fragment.HEADER_SIZE + fragment.length
 
 
 class Fragment:
-    HEADER_SIZE = 7
-
-    def __init__(self, reader):
-        self.read_header(reader)
-        self.data = reader.n_bytes(self.length)
-
-    def read_header(self, reader):
-        self.checksum = reader.uint(4)
-        self.length = reader.uint(2)
-        self.type = reader.uint(1)
+    __slots__ = ("checksum", "length", "type", "data")
+    HEADER = struct.Struct("<IHB")  # checksum, length, type
+    HEADER_SIZE = HEADER.size
+
+    def __init__(self, block, offset):
+        self.read_header(block, offset)
+        start = offset + Fragment.HEADER_SIZE
+        self.data = block[start : start + self.length]
+
+    def read_header(self, block, offset):
+        self.checksum, self.length, self.type = Fragment.HEADER.unpack_from(
+            block, offset
+        )
 
 
 class Batch:
-    def __init__(self, buffer):
-        self.reader = reader = Batch.make_reader(buffer)
-        self.sequence_number = reader.uint(8)
-        self.count = reader.uint(4)
+    __slots__ = ("reader", "sequence_number", "count")
+    HEADER = struct.Struct("<QI")  # sequence number, count
+
+    def __init__(self, data):
+        self.reader = reader = MemReader(data)
+        self.sequence_number, self.count = reader.unpack(Batch.HEADER)
 
     def __iter__(self):
         reader = self.reader
-        if reader.bytes_left() == 0:
+        if reader.pos == reader.size:
             return
         for i in range(self.count):
-            value_type = reader.uint(1)
+            value_type = reader.u8()
             size = reader.varint()
-            key = reader.n_bytes(size)
+            key = reader.take_bytes(size)
             if value_type == 1:  # PUT
                 size = reader.varint()
-                value = reader.n_bytes(size)
+                value = reader.take_bytes(size)
                 yield "put", (key, value)
             else:  # DEL
                 yield "delete", (key,)
-        assert reader.bytes_left() == 0
-
-    @staticmethod
-    def make_reader(buffer):
-        buffer.seek(0)
-        size = len(buffer.getbuffer())
-        return BytesReader(buffer, size)
+        assert reader.pos == reader.size
 
 
 # Table files
@@ -423,7 +522,7 @@ class TableReader:
     @staticmethod
     def dump(filepath):
         with open(filepath, "rb") as file:
-            reader = BytesReader(file, filesize(filepath))
+            reader = TableReader.make_reader(file, filepath)
             footer = TableFooter(reader)
             for key, handle in TableIndex(footer.index_handle, reader):
                 for key, value in TableData(handle, reader):
@@ -435,7 +534,7 @@ class TableReader:
         # return at first key found, since it seems repeated keys
         # are sorted by last-inserted first.
         with open(filepath, "rb") as file:
-            reader = BytesReader(file, filesize(filepath))
+            reader = TableReader.make_reader(file, filepath)
             footer = TableFooter(reader)
             for internal_key, handle in TableIndex(footer.index_handle, reader):
                 result = bytestring_less_or_equal(target_key, internal_key.user_key)
@@ -458,15 +557,32 @@ class TableReader:
         # return at first key found, since it seems repeated keys
         # are sorted by last-inserted first.
         with open(filepath, "rb") as file:
-            reader = BytesReader(file, filesize(filepath))
+            prefetch(file)  # every block is read
+            reader = TableReader.make_reader(file, filepath)
             footer = TableFooter(reader)
-            for internal_key, handle in TableIndex(footer.index_handle, reader):
+            for _, handle in TableIndex(footer.index_handle, reader):
                 for internal_key, value in TableData(handle, reader):
                     if internal_key.user_key == target_key:
                         return value
 
+    @staticmethod
+    def make_reader(file, filepath):
+        # tables are read by jumping around; pread saves the seeks
+        if hasattr(os, "pread"):  # not available on Windows
+            file = PreadFile(file)
+        return BytesReader(file, filesize(filepath))
+
 
 class TableBlock:
+    __slots__ = (
+        "offset",
+        "size",
+        "reader",
+        "compression",
+        "data",
+        "restart_offset",
+    )
+
     def __init__(self, handle, reader):
         self.offset = handle.offset
         self.size = handle.size
@@ -477,23 +593,28 @@ class TableBlock:
 
     def read_compression(self, reader):
         reader.seek(self.offset + self.size)
-        self.compression = reader.uint(1)
+        self.compression = reader.u8()
 
     def read_data(self, reader):
         reader.seek(self.offset)
-        self.data = reader.n_bytes(self.size, compression=self.compression)
+        self.data = decompress(reader.n_bytes(self.size), self.compression)
+        self.restart_offset = KeyValueReader.find_restart_offset(self.data)
 
     def __iter__(self):
-        yield from KeyValueReader(BytesReader.from_bytes(self.data))
+        yield from KeyValueReader(self.data, self.restart_offset)
 
 
 class TableData(TableBlock):
+    __slots__ = ()
+
     def __iter__(self):
         for key, value in super().__iter__():
             yield InternalKey.from_bytes(key), value
 
 
 class TableIndex(TableBlock):
+    __slots__ = ()
+
     def __iter__(self):
         for key, value in super().__iter__():
             yield InternalKey.from_bytes(key), BlockHandle.from_bytes(value)
@@ -511,7 +632,7 @@ class TableFooter:
 
     def check_magic_number(self, reader):
         reader.seek(-TableFooter.MAGIC_NUMBER_LENGTH, os.SEEK_END)
-        number = reader.uint(TableFooter.MAGIC_NUMBER_LENGTH)
+        number = reader.u64()
         assert number == TableFooter.MAGIC_NUMBER
 
     def read_handles(self, reader):
@@ -524,45 +645,51 @@ class TableFooter:
 class KeyValueReader:
     # list of key/value-entries and a trailer of restarts
     # https://github.com/google/leveldb/blob/main/table/block_builder.cc#L16
-    def __init__(self, reader):
-        self.reader = reader
+    def __init__(self, data, restart_offset):
+        # entries occupy `data[:restart_offset]`
+        self.reader = MemReader(data)
+        self.restart_offset = restart_offset
 
     def __iter__(self):
         reader = self.reader
-        reader.seek(reader.size - 4)
-        num_restarts = reader.uint(4)
-        restart_offset = reader.size - (1 + num_restarts) * 4
+        restart_offset = self.restart_offset
         last_key = b""
-        reader.seek(0)
-        while reader.pos() < restart_offset:
+        while reader.pos < restart_offset:
             # https://github.com/google/leveldb/blob/main/table/block.cc#L48-L75
             shared = reader.varint()
             unshared = reader.varint()
             value_length = reader.varint()
             assert shared <= len(last_key)
-            key_prefix = last_key[:shared]
-            key_suffix = reader.n_bytes(unshared)
-            key = last_key = key_prefix + key_suffix
-            value = reader.n_bytes(value_length)
+            key = last_key = last_key[:shared] + reader.take(unshared)
+            value = reader.take_bytes(value_length)
             yield key, value
 
+    @staticmethod
+    def find_restart_offset(data):
+        num_restarts = unpack_u32(data, len(data) - 4)[0]
+        return len(data) - (1 + num_restarts) * 4
+
 
 class InternalKey:
+    __slots__ = ("user_key", "value_type", "sequence_number")
+
     @staticmethod
     def from_bytes(bytestring):
-        prefix, suffix = bytestring[:-8], bytestring[-8:]
-        suffix_reader = BytesReader.from_bytes(suffix)
+        # the last 8 bytes are (sequence_number << 8) | value_type
+        suffix = unpack_u64(bytestring, len(bytestring) - 8)[0]
         result = InternalKey()
-        result.user_key = prefix
-        result.value_type = suffix_reader.uint(1)
-        result.sequence_number = suffix_reader.uint(7)
+        result.user_key = bytestring[:-8]
+        result.value_type = suffix & 0xFF
+        result.sequence_number = suffix >> 8
         return result
 
 
 class BlockHandle:
+    __slots__ = ("offset", "size")
+
     def __init__(self, reader):
-        self.offset = reader.varint()
-        self.size = reader.varint()
+        self.offset = reader.varint_fast()
+        self.size = reader.varint_fast()
 
     @staticmethod
     def from_bytes(bytestring):
@@ -572,8 +699,17 @@ class BlockHandle:
 
 # Helpers
 
+MAX_VARINT_LENGTH = 10  # 64-bit integers
+
+# little-endian fixed-width integers
+unpack_u8 = struct.Struct("<B").unpack_from
+unpack_u32 = struct.Struct("<I").unpack_from
+unpack_u64 = struct.Struct("<Q").unpack_from
+
 
 class BytesReader:
+    __slots__ = ("file", "size")
+
     def __init__(self, file, size):
         self.file = file
         self.size = size
@@ -584,32 +720,14 @@ class BytesReader:
 
     # Readers
 
-    def n_bytes(self, n_bytes, compression=None):
-        raw_bytes = self.file.read(n_bytes)
-        if not compression:
-            return raw_bytes
-        elif compression == 1:  # snappy
-            try:
-                import snappy
-            except ImportError:
-                print(
-                    "Your information appears to be compressed with the snappy compression format.\n"
-                    "\n"
-                    "Install the snappy decompression library if possible:\n"
-                    "\n"
-                    "  /usr/bin/env python -m pip install python-snappy\n"
-                )
-                sys.exit(1)
-            return snappy.uncompress(raw_bytes)
-        else:
-            raise NotImplementedError(f"compression type {compression} not known.")
+    def n_bytes(self, n_bytes):
+        return self.file.read(n_bytes)
 
-    def n_varints(self, n):
-        return [self.varint() for _ in range(n)]
+    def u8(self):
+        return unpack_u8(self.file.read(1))[0]
 
-    def uint(self, n_bytes):
-        bytestring = self.n_bytes(n_bytes)
-        return int.from_bytes(bytestring, byteorder="little")
+    def u64(self):
+        return unpack_u64(self.file.read(8))[0]
 
     def varint(self):
         value = 0
@@ -622,16 +740,19 @@ class BytesReader:
             shift += 7
         return value
 
+    def varint_fast(self):
+        """Like `varint`, but with one bulk read instead of one per byte."""
+        start = self.file.tell()
+        buffer = self.file.read(MAX_VARINT_LENGTH)
+        value, length = decode_varint(buffer, 0)
+        self.file.seek(start + length)
+        return value
+
     # Helpers
 
     def bytes_left(self):
         return max(0, self.size - self.pos())
 
-    def limit(self, n_bytes):
-        limited_file = LimitedFile(self.file, n_bytes)
-        new_size = min(limited_file.max_offset, self.size)
-        return BytesReader(limited_file, new_size)
-
     def pos(self):
         return self.file.tell()
 
@@ -639,6 +760,42 @@ class BytesReader:
         return self.file.seek(target, whence)
 
 
+class MemReader:
+    """Like `BytesReader`, but an integer cursor over an in-memory buffer."""
+
+    __slots__ = ("buf", "pos", "size")
+
+    def __init__(self, bytestring):
+        self.buf = memoryview(bytestring)
+        self.pos = 0
+        self.size = len(self.buf)
+
+    # Readers
+
+    def take(self, n_bytes):
+        """Return the next `n_bytes` as a memoryview (no copy)."""
+        start = self.pos
+        self.pos = start + n_bytes
+        return self.buf[start : self.pos]
+
+    def take_bytes(self, n_bytes):
+        return self.take(n_bytes).tobytes()
+
+    def unpack(self, struct_format):
+        values = struct_format.unpack_from(self.buf, self.pos)
+        self.pos += struct_format.size
+        return values
+
+    def u8(self):
+        value = self.buf[self.pos]
+        self.pos += 1
+        return value
+
+    def varint(self):
+        value, self.pos = decode_varint(self.buf, self.pos)
+        return value
+
+
 class BytesMaker:
     @staticmethod
     def varint(integer):
@@ -655,21 +812,35 @@ class BytesMaker:
         return bytes(buffer)
 
 
-class LimitedFile:
-    def __init__(self, file, n_bytes):
-        self.file = file
-        self.max_offset = file.tell() + n_bytes
+class PreadFile:
+    """Positional reads with `os.pread`, so a seek costs no system call."""
+
+    __slots__ = ("fd", "offset", "size")
+
+    def __init__(self, file):
+        self.fd = file.fileno()
+        self.offset = 0
+        self.size = os.fstat(self.fd).st_size
 
     def tell(self):
-        return self.file.tell()
+        return self.offset
+
+    def seek(self, target, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            target += self.offset
+        elif whence == os.SEEK_END:
+            target += self.size
+        if target < 0:
+            raise OSError(f"invalid offset {target}")
+        self.offset = target
+        return target
 
     def read(self, n_bytes=None):
-        current_offset = self.tell()
-        bytes_left = self.max_offset - current_offset
-        assert bytes_left >= 0
-        if n_bytes is None:
-            n_bytes = bytes_left
-        return self.file.read(min(n_bytes, bytes_left))
+        if n_bytes is None or n_bytes < 0:
+            n_bytes = max(0, self.size - self.offset)
+        data = os.pread(self.fd, n_bytes, self.offset)
+        self.offset += len(data)
+        return data
 
 
 def bytestring_less_or_equal(bytestring1, bytestring2):
@@ -706,26 +877,25 @@ def bytestring_less_or_equal(bytestring1, bytestring2):
         return bytestring1 <= bytestring1
 
     # type "!" or "#"
-    prefix_hashes_left = 2 if type1 == b"!" else 4
-    read_varint = False
+    # Up to and including the n-th "#", keys compare alphanumerically;
+    # if they differ there, that settles it without skipping varints.
+    prefix_hashes = 2 if type1 == b"!" else 4
+    prefix_end1 = find_prefix_end(bytestring1, prefix_hashes)
+    prefix_end2 = find_prefix_end(bytestring2, prefix_hashes)
+    if (
+        prefix_end1 is None
+        or prefix_end1 != prefix_end2
+        or bytestring1[:prefix_end1] != bytestring2[:prefix_end2]
+    ):
+        return bytestring1 <= bytestring2
+
+    read_varint = True
     reader1 = BytesReader.from_bytes(bytestring1)
     reader2 = BytesReader.from_bytes(bytestring2)
+    reader1.seek(prefix_end1)
+    reader2.seek(prefix_end2)
     while reader1.bytes_left() and reader2.bytes_left():
         # --------------------------------------------------
-        # prefix
-        # --------------------------------------------------
-        if prefix_hashes_left > 0:
-            byte1, byte2 = reader1.n_bytes(1), reader2.n_bytes(1)
-            if byte1 < byte2:
-                return True
-            elif byte1 > byte2:
-                return False
-            elif byte1 == b"#":  # same bytes
-                prefix_hashes_left -= 1
-                if prefix_hashes_left == 0:
-                    read_varint = True
-            continue
-        # --------------------------------------------------
         # suffix with data
         # --------------------------------------------------
         if read_varint:
@@ -748,9 +918,76 @@ def bytestring_less_or_equal(bytestring1, bytestring2):
     return len(bytestring1) <= len(bytestring2)
 
 
-def clear(buffer):
-    buffer.truncate(0)
-    buffer.seek(0)
+def find_prefix_end(bytestring, n_hashes):
+    """Index right after the `n_hashes`-th "#" in `bytestring`, or None."""
+    index = -1
+    for _ in range(n_hashes):
+        index = bytestring.find(b"#", index + 1)
+        if index == -1:
+            return None
+    return index + 1
+
+
+def decode_varint(buffer, offset):
+    """
+    Decode the varint starting at `offset` in `buffer`.
+
+    Returns a `(value, new_offset)`-pair. Lengths and offsets in these
+    files rarely need more than 5 bytes (35 bits), so those sizes are
+    spelled out with constant shifts; anything longer takes the loop.
+    """
+    byte = buffer[offset]
+    if byte < 0b10000000:
+        return byte, offset + 1
+    value = byte & 0b01111111
+    byte = buffer[offset + 1]
+    if byte < 0b10000000:
+        return value | (byte << 7), offset + 2
+    value |= (byte & 0b01111111) << 7
+    byte = buffer[offset + 2]
+    if byte < 0b10000000:
+        return value | (byte << 14), offset + 3
+    value |= (byte & 0b01111111) << 14
+    byte = buffer[offset + 3]
+    if byte < 0b10000000:
+        return value | (byte << 21), offset + 4
+    value |= (byte & 0b01111111) << 21
+    byte = buffer[offset + 4]
+    if byte < 0b10000000:
+        return value | (byte << 28), offset + 5
+    value |= (byte & 0b01111111) << 28
+    shift = 35
+    offset += 5
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0b01111111) << shift
+        if not (byte & 0b10000000):
+            return value, offset
+        shift += 7
+
+
+def decompress(raw_bytes, compression):
+    global snappy_uncompress
+    if not compression:
+        return raw_bytes
+    elif compression == 1:  # snappy
+        if snappy_uncompress is None:
+            # imported here, since most runs never open a compressed table
+            try:
+                from snappy import uncompress as snappy_uncompress
+            except ImportError:
+                print(
+                    "Your information appears to be compressed with the snappy compression format.\n"
+                    "\n"
+                    "Install the snappy decompression library if possible:\n"
+                    "\n"
+                    "  /usr/bin/env python -m pip install python-snappy\n"
+                )
+                sys.exit(1)
+        return snappy_uncompress(raw_bytes)
+    else:
+        raise NotImplementedError(f"compression type {compression} not known.")
 
 
 def convert_escaped_string_to_bytes(s: str):
@@ -765,19 +1002,47 @@ def filesize(filepath):
     return os.path.getsize(filepath)
 
 
-def get_files_in_dir_modified_last_first(path):
-    result = []
-    for dirpath, dirnames, filenames in os.walk(path):
-        result.extend(os.path.join(dirpath, filename) for filename in filenames)
-    result.sort(key=modified, reverse=True)
-    return result
+def map_file(file):
+    """Memory-map `file` for reading, so reads need no system calls."""
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:  # empty files can't be mapped
+        return io.BytesIO()
 
 
-def modified(filepath):
+def prefetch(file):
+    """Ask the kernel to start reading all of `file` into the page cache."""
+    # POSIX_FADV_* are advice values, not flags; they can't be combined.
+    if not hasattr(os, "posix_fadvise"):  # not available on Windows/macOS
+        return
     try:
-        return os.path.getmtime(filepath)
-    except FileNotFoundError:
-        return float("Inf")
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+
+
+def get_files_in_dir_modified_last_first(path):
+    # `DirEntry.stat()` is cached, so each file is stat'ed only once.
+    result = []
+    dirpaths = [path]
+    while dirpaths:
+        try:
+            entries = os.scandir(dirpaths.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirpaths.append(entry.path)
+                    continue
+                try:
+                    mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    mtime = float("Inf")
+                result.append((mtime, entry.path))
+    result.sort(key=lambda item: item[0], reverse=True)
+    return [filepath for _, filepath in result]
 
 
 # ======================================================================
@@ -871,4 +1136,4 @@ if __name__ == "__main__":
         )
         sys.exit(2)
 
-    print(_process(raw_rootlist, user_id, folder_id))
+    _process(raw_rootlist, user_id, folder_id)